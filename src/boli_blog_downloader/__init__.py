@@ -1,7 +1,19 @@
 import logging
+import logging.handlers
 
 
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(
+    logging.Formatter('%(asctime)s | %(levelname)-8s | %(name)-40s | %(message)s')
+)
+
 logging.basicConfig(
     level=logging.DEBUG,
-    format='%(asctime)s | %(levelname)-8s | %(name)-40s | %(message)s',
+    handlers=[
+        logging.handlers.MemoryHandler(
+            capacity=1000,
+            flushLevel=logging.WARNING,
+            target=_stream_handler,
+        )
+    ],
 )
@@ -1,18 +1,38 @@
+from concurrent.futures import (
+    FIRST_EXCEPTION,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import contextmanager
 from dataclasses import dataclass
+from typing import Any, Callable
+from http import HTTPStatus
 import hashlib
+import json
 import logging
 import os
+import re
+from pathlib import Path
+import shutil
+import tempfile
+import threading
 import time
 from urllib.parse import urlparse
+import filetype
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+import soupsieve
 
 
 class DownloaderException(Exception):
     pass
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class DownloadItem:
     year: int
     month: int
@@ -24,6 +44,15 @@ class DownloaderApp:
     PAGE_ROOT = "https://boli-blog.pl/"
     DOWNLOAD_TIMEOUT = 10
     DOWNLOAD_DELAY = 0
+    DOWNLOAD_CHUNK_SIZE = 65536
+    DOWNLOAD_WORKERS = 8
+    IMAGE_WORKERS = 16
+    DOWNLOAD_RETRIES = 3
+    DOWNLOAD_BACKOFF = 0.5
+    DOWNLOAD_RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+    POOL_CONNECTIONS = 16
+    POOL_MAXSIZE = 64
 
     CACHE_DIR = "cache"
     IMAGES_DIR = "images"
@@ -35,8 +64,39 @@ class DownloaderApp:
         "blogspot.com",
     ]
 
+    # filetype needs at most this many leading bytes to recognize a format
+    IMAGE_HEADER_SIZE = 261
+
+    # bump whenever extract_posts() or extract_images() change their output
+    EXTRACTED_VERSION = 2
+
+    # while parsing the strainer sees the raw multi-valued class attribute
+    ARTICLE_STRAINER = SoupStrainer(
+        "article", attrs={"class": re.compile(r"(^|\s)post(\s|$)")}
+    )
+
+    ARCHIVE_SELECTOR = soupsieve.compile("aside.widget_archive")
+    ARCHIVE_LINK_SELECTOR = soupsieve.compile("a")
+    ARTICLE_SELECTOR = soupsieve.compile("article.post")
+    ARTICLE_LINK_SELECTOR = soupsieve.compile("h1.entry-title a")
+    CONTENT_SELECTOR = soupsieve.compile("div.entry-content")
+    CONTENT_IMAGE_SELECTOR = soupsieve.compile("img[src]")
+
     def __init__(self) -> None:
         self.__logger = logging.getLogger(f"DownloaderApp{id(self)}")
+        self.__session = self.__create_session()
+        self.__io_pool = ThreadPoolExecutor(max_workers=self.IMAGE_WORKERS)
+        self.__cache_index: set[str] = set()
+        self.__image_futures: dict[str, Future] = {}
+        self.__image_lock = threading.Lock()
+        self.__cancelled = threading.Event()
+        # mkstemp creates files as 0600, cache files should follow the umask
+        umask = os.umask(0)
+        os.umask(umask)
+        self.__file_mode = 0o666 & ~umask
+        self.__content_re = re.compile(
+            "|".join(re.escape(source) for source in self.CONTENT_SOURCES)
+        )
 
     def run(self) -> int:
         self.__logger.debug("run()")
@@ -45,6 +105,13 @@ class DownloaderApp:
             os.makedirs(self.CACHE_DIR, exist_ok=True)
             os.makedirs(self.IMAGES_DIR, exist_ok=True)
 
+            self.__cache_index = set(os.listdir(self.CACHE_DIR))
+
+            # the image pool is shut down when a run ends, start each run afresh
+            self.__io_pool = ThreadPoolExecutor(max_workers=self.IMAGE_WORKERS)
+            self.__image_futures = {}
+            self.__cancelled.clear()
+
             items = self.__download_root_page()
             # items = [
             #     DownloadItem(2023, 10, "https://boli-blog.pl/2023/10/"),
@@ -53,10 +120,13 @@ class DownloaderApp:
 
             self.__process_items(items)
 
-        except (DownloaderException, requests.HTTPError):
+        except (DownloaderException, requests.RequestException):
             self.__logger.exception("Download files due to exception")
             return 1
 
+        finally:
+            self.__io_pool.shutdown(cancel_futures=True)
+
         return 0
 
     def __process_items(self, items: list[DownloadItem]) -> None:
@@ -65,36 +135,50 @@ class DownloaderApp:
         if len(items) == 0:
             return
 
-        last_item = items.pop()
+        # the latest month may still be getting new posts, so always refresh it
+        last_idx = len(items) - 1
 
-        for item in items:
-            self.__process_item(item)
+        with ThreadPoolExecutor(max_workers=self.DOWNLOAD_WORKERS) as executor:
+            futures = [
+                executor.submit(self.__process_item, item, refresh=idx == last_idx)
+                for idx, item in enumerate(items)
+            ]
 
-        self.__process_item(last_item, refresh=True)
+            try:
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    future.result()
+            except BaseException:
+                # stop at the first failure (or interrupt) instead of crawling
+                # the remaining months only to report the error at the end
+                self.__cancelled.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
 
     def __process_item(self, item: DownloadItem, refresh: bool = False) -> None:
         self.__logger.debug(f"process_item() item={item} refresh={refresh}")
 
-        page_text = self.__download_page(
-            item.href, use_cache=False if refresh else True
+        posts = self.__extract_page(
+            item.href, self.__extract_posts, use_cache=False if refresh else True
         )
+        for post_id, post_href in posts:
+            if self.__cancelled.is_set():
+                return
 
-        soup = BeautifulSoup(page_text, "html.parser")
+            self.__process_post(item, post_id, post_href)
 
-        articles = soup.find_all("article", attrs={"class": "post"})
-        for article in articles:
+    def __extract_posts(self, page_text: str) -> list[tuple[str, str]]:
+        soup = BeautifulSoup(page_text, "lxml", parse_only=self.ARTICLE_STRAINER)
+
+        posts = []
+
+        for article in self.ARTICLE_SELECTOR.iselect(soup):
             try:
                 post_id = article.attrs["id"]
             except KeyError as e:
                 raise DownloaderException(f"Article missing ID: {article}") from e
 
-            title = article.find("h1", attrs={"class": "entry-title"})
-            if title is None:
-                raise DownloaderException(
-                    f"Article title not found in article: {article}"
-                )
-
-            article_a = title.find("a")
+            article_a = self.ARTICLE_LINK_SELECTOR.select_one(article)
             if article_a is None:
                 raise DownloaderException(
                     f"Article address not found in article: {article}"
@@ -107,7 +191,9 @@ class DownloaderApp:
                     f"Article address missing HREF: {article}"
                 ) from e
 
-            self.__process_post(item, post_id, post_href)
+            posts.append((post_id, post_href))
+
+        return posts
 
     def __process_post(self, item: DownloadItem, post_id: str, post_href: str):
         self.__logger.debug(f"process_post() id={post_id} post_href={post_href}")
@@ -120,44 +206,11 @@ class DownloaderApp:
 
         self.__logger.debug(f"process_post() - calculated ID: {id_string}")
 
-        page_text = self.__download_page(post_href)
-
-        soup = BeautifulSoup(page_text, "html.parser")
-
-        content = soup.find("div", attrs={"class": "entry-content"})
-        if content is None:
-            raise DownloaderException("Content not found")
-
-        image_sources = []
-
-        images = content.find_all("img")
-        for image in images:
-            self.__logger.debug(f"process_post() image found: {image}")
-
-            try:
-                image_src = image.attrs["src"]
-            except KeyError as e:
-                raise DownloaderException(f"Image missing SRC: {image}") from e
-
-            image_sources.append(image_src)
-
-            image_parent = image.parent
-
-            self.__logger.debug(f"Image parent: {image_parent}")
-
-            if image_parent.name != "a":
-                continue
-
-            try:
-                parent_href = image_parent.attrs["href"]
-            except KeyError as e:
-                raise DownloaderException(f"Image parent missing SRC: {image}") from e
+        image_sources = self.__extract_page(post_href, self.__extract_images)
 
-            image_sources.append(parent_href)
-
-        subid = 0
+        valid_sources = []
         for image_source in image_sources:
-            self.__logger.debug(f"process_post() processing image: {image_sources}")
+            self.__logger.debug(f"process_post() processing image: {image_source}")
 
             # skip = False
             # for filter_prefix in self.FILTER_LIST:
@@ -167,61 +220,109 @@ class DownloaderApp:
             # if skip:
             #     continue
 
-            source_valid = False
-            for source in self.CONTENT_SOURCES:
-                if image_source.find(source) >= 0:
-                    source_valid = True
-                    break
-            if not source_valid:
+            if not self.__content_re.search(image_source):
                 self.__logger.info(f"Skipping: {image_source} from {post_href}")
                 continue
 
-            image_data = self.__download_image(image_source)
+            valid_sources.append(image_source)
+
+        futures: dict[Future, list[tuple[int, str]]] = {}
+        for subid, image_source in enumerate(valid_sources):
+            future = self.__submit_image(image_source)
+            futures.setdefault(future, []).append((subid, image_source))
+
+        for future in as_completed(futures):
+            image_path = future.result()
+
+            with open(image_path, mode="rb") as image_file:
+                image_header = image_file.read(self.IMAGE_HEADER_SIZE)
 
-            ext = self.__calculate_extension(image_data)
+            ext = self.__calculate_extension(image_header)
             if ext is None:
                 self.__logger.debug(
-                    f"Mime unknown: {image_source} from {post_href} bytes {image_data[0:32]}"
+                    f"Mime unknown: {image_path} from {post_href} bytes {image_header[0:32]}"
                 )
                 ext = ".dat"
 
             self.__logger.debug(f"process_post() image extension: {ext}")
 
-            file_name = f"{item.year:04d}-{item.month:02d}-{id_string}-{subid:04d}"
-            subid = subid + 1
+            for subid, image_source in futures[future]:
+                file_name = f"{item.year:04d}-{item.month:02d}-{id_string}-{subid:04d}"
+
+                file_path = f"{self.IMAGES_DIR}/{file_name}{ext}"
+
+                self.__logger.debug(
+                    f"process_post() file path: {file_path} from {image_source}"
+                )
+
+                shutil.copyfile(image_path, file_path)
+
+    def __extract_images(self, page_text: str) -> list[str]:
+        soup = BeautifulSoup(page_text, "lxml")
+
+        content = self.CONTENT_SELECTOR.select_one(soup)
+        if content is None:
+            raise DownloaderException("Content not found")
+
+        # rendering a tag re-serializes its subtree, skip it unless logged
+        debug_enabled = self.__logger.isEnabledFor(logging.DEBUG)
+
+        image_sources = []
+
+        for image in self.CONTENT_IMAGE_SELECTOR.iselect(content):
+            if debug_enabled:
+                self.__logger.debug(f"extract_images() image found: {image}")
+
+            image_sources.append(image.attrs["src"])
+
+            image_parent = image.parent
 
-            file_path = f"{self.IMAGES_DIR}/{file_name}{ext}"
+            if debug_enabled:
+                self.__logger.debug(f"Image parent: {image_parent}")
 
-            self.__logger.debug(f"process_post() file path: {file_path}")
+            if image_parent.name != "a":
+                continue
 
-            with open(file_path, mode="wb") as image_file:
-                image_file.write(image_data)
+            try:
+                parent_href = image_parent.attrs["href"]
+            except KeyError as e:
+                raise DownloaderException(f"Image parent missing SRC: {image}") from e
+
+            image_sources.append(parent_href)
+
+        return image_sources
+
+    def __submit_image(self, href: str) -> Future:
+        # the same image is often linked from several posts, download it once
+        href = urlparse(href)._replace(fragment="").geturl()
+
+        with self.__image_lock:
+            future = self.__image_futures.get(href)
+            if future is None:
+                future = self.__io_pool.submit(self.__download_image, href)
+                self.__image_futures[href] = future
+
+        return future
 
     def __calculate_extension(self, image_data: bytes) -> str | None:
-        if len(image_data) < 10:
+        kind = filetype.guess(image_data)
+        if kind is None:
             return None
 
-        if image_data[0:4] == b"\x89PNG":
-            return ".png"
-        elif image_data[0:10] == b"\xff\xd8\xff\xe0\x00\x10JFIF":
-            return ".jpg"
-        elif image_data[0:6] == b"GIF89a":
-            return ".gif"
-
-        return None
+        return f".{kind.extension}"
 
     def __download_root_page(self) -> list[DownloadItem]:
         self.__logger.debug("download_root_page()")
 
         page_text = self.__download_page(self.PAGE_ROOT)
 
-        soup = BeautifulSoup(page_text, "html.parser")
+        soup = BeautifulSoup(page_text, "lxml")
 
-        archive = soup.find("aside", attrs={"class": "widget_archive"})
+        archive = self.ARCHIVE_SELECTOR.select_one(soup)
         if archive is None:
             raise DownloaderException("Archive not found")
 
-        archive_list = archive.find_all("a")
+        archive_list = self.ARCHIVE_LINK_SELECTOR.select(archive)
         if archive_list is None:
             raise DownloaderException("Archive list is invalid")
 
@@ -232,9 +333,13 @@ class DownloaderApp:
             except KeyError as e:
                 raise DownloaderException("Archive list item missing HREF") from e
 
-            tokens = list(reversed(list(filter(None, item_address.split("/")))))
+            parts = urlparse(item_address).path.strip("/").split("/")
+            if len(parts) < 2:
+                raise DownloaderException(
+                    f"Unsupported archive address: {item_address}"
+                )
 
-            item = DownloadItem(int(tokens[1]), int(tokens[0]), item_address)
+            item = DownloadItem(int(parts[-2]), int(parts[-1]), item_address)
 
             self.__logger.debug(f"download_root_page() - found item: {item}")
 
@@ -242,55 +347,211 @@ class DownloaderApp:
 
         return items
 
-    def __download_page(self, href: str, use_cache: bool = True) -> str:
+    def __page_file_name(self, href: str) -> str:
+        return href.replace(":", "_").replace("/", "_") + ".html"
+
+    def __extracted_name(self, file_name: str) -> str:
+        return f"{os.path.splitext(file_name)[0]}.extracted.json"
+
+    def __extract_page(
+        self, href: str, extract: Callable[[str], Any], use_cache: bool = True
+    ) -> Any:
+        # the extracted data only changes with the page, so keep it next to the
+        # cached page and skip both reading and parsing it while it is current
+        page_text = None
+        if not use_cache:
+            # a changed page drops its extracted data when it is stored, an
+            # unchanged one (None) is only read below if it has to be parsed
+            page_text = self.__download_page(href, use_cache=False)
+
+        page_name = self.__page_file_name(href)
+        extracted_name = self.__extracted_name(page_name)
+        extracted_path = f"{self.CACHE_DIR}/{extracted_name}"
+
+        if page_name in self.__cache_index and extracted_name in self.__cache_index:
+            extracted = json.loads(Path(extracted_path).read_text(encoding="utf-8"))
+            # data written before versioning was a bare list
+            if (
+                isinstance(extracted, dict)
+                and extracted.get("version") == self.EXTRACTED_VERSION
+            ):
+                self.__logger.debug(
+                    f"extract_page() - reading from file: {extracted_path}"
+                )
+
+                return extracted["data"]
+
+        if page_text is None:
+            page_text = self.__download_page(href)
+
+        data = extract(page_text)
+
+        with self.__open_atomic(
+            extracted_path, mode="wt", encoding="utf-8"
+        ) as extracted_file:
+            json.dump({"version": self.EXTRACTED_VERSION, "data": data}, extracted_file)
+        self.__cache_index.add(extracted_name)
+
+        return data
+
+    def __download_page(self, href: str, use_cache: bool = True) -> str | None:
         self.__logger.debug(f"download_page() href={href} use_cache={use_cache}")
 
-        file_name = href.replace(":", "_").replace("/", "_")
-        file_path = f"{self.CACHE_DIR}/{file_name}.html"
+        file_name = self.__page_file_name(href)
+        file_path = f"{self.CACHE_DIR}/{file_name}"
 
         if use_cache:
-            if os.path.isfile(file_path):
+            if file_name in self.__cache_index:
                 self.__logger.debug(f"download_page() - reading from file: {file_path}")
 
-                with open(file_path, mode="rt", encoding="utf-8") as data_file:
-                    return data_file.read()
+                return Path(file_path).read_text(encoding="utf-8")
 
         self.__logger.debug(f"download_page() - reading from HREF: {href}")
 
-        response = self.__request_data(href)
+        response = self.__request_data(
+            href, headers=self.__conditional_headers(file_name)
+        )
+
+        if response.status_code == HTTPStatus.NOT_MODIFIED:
+            self.__logger.debug(f"download_page() - not modified: {file_path}")
+
+            # the cached copy is current, leave reading it to the caller
+            return None
+
+        # drop the old extracted data before replacing the page, so a crash in
+        # between can never pair the new page with it
+        self.__remove_cached(self.__extracted_name(file_name))
 
-        with open(file_path, mode="wt", encoding="utf-8") as page_file:
+        with self.__open_atomic(file_path, mode="wt", encoding="utf-8") as page_file:
             page_file.write(response.text)
+        self.__cache_index.add(file_name)
+
+        # only downloads that bypass the cache are ever revalidated
+        if not use_cache:
+            self.__store_meta(file_name, response)
 
         return response.text
 
-    def __download_image(self, href: str, use_cache: bool = True) -> bytes:
+    def __download_image(self, href: str, use_cache: bool = True) -> str:
         self.__logger.debug(f"download_image() href={href} use_cache={use_cache}")
 
-        file_hash = hashlib.sha256(href.encode()).hexdigest()
-        file_path = f"{self.CACHE_DIR}/{file_hash}.bin"
+        file_hash = hashlib.blake2b(href.encode(), digest_size=16).hexdigest()
+        file_name = f"{file_hash}.bin"
+        file_path = f"{self.CACHE_DIR}/{file_name}"
 
         if use_cache:
-            if os.path.isfile(file_path):
+            if file_name in self.__cache_index:
                 self.__logger.debug(
                     f"download_image() - reading from file: {file_path}"
                 )
 
-                with open(file_path, mode="rb") as data_file:
-                    return data_file.read()
+                return file_path
 
         self.__logger.debug(f"download_image() - reading from HREF: {href}")
 
-        response = self.__request_data(href)
+        with self.__request_data(
+            href, stream=True, headers=self.__conditional_headers(file_name)
+        ) as response:
+            if response.status_code == HTTPStatus.NOT_MODIFIED:
+                self.__logger.debug(f"download_image() - not modified: {file_path}")
+
+                return file_path
+
+            with self.__open_atomic(file_path, mode="wb") as data_file:
+                for chunk in response.iter_content(self.DOWNLOAD_CHUNK_SIZE):
+                    data_file.write(chunk)
+        self.__cache_index.add(file_name)
 
-        with open(file_path, mode="wb") as test_file:
-            test_file.write(response.content)
+        if not use_cache:
+            self.__store_meta(file_name, response)
 
-        return response.content
+        return file_path
 
-    def __request_data(self, href: str):
-        response = requests.get(href, timeout=self.DOWNLOAD_TIMEOUT)
-        response.raise_for_status()
+    def __meta_name(self, file_name: str) -> str:
+        return f"{os.path.splitext(file_name)[0]}.meta.json"
+
+    def __conditional_headers(self, file_name: str) -> dict[str, str]:
+        meta_name = self.__meta_name(file_name)
+        if file_name not in self.__cache_index or meta_name not in self.__cache_index:
+            return {}
+
+        meta = json.loads(
+            Path(f"{self.CACHE_DIR}/{meta_name}").read_text(encoding="utf-8")
+        )
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+        return headers
+
+    def __store_meta(self, file_name: str, response: requests.Response) -> None:
+        meta = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        meta_name = self.__meta_name(file_name)
+
+        if not any(meta.values()):
+            self.__remove_cached(meta_name)
+            return
+
+        with self.__open_atomic(
+            f"{self.CACHE_DIR}/{meta_name}", mode="wt", encoding="utf-8"
+        ) as meta_file:
+            json.dump(meta, meta_file)
+        self.__cache_index.add(meta_name)
+
+    def __remove_cached(self, file_name: str) -> None:
+        if file_name in self.__cache_index:
+            os.remove(f"{self.CACHE_DIR}/{file_name}")
+            self.__cache_index.discard(file_name)
+
+    @contextmanager
+    def __open_atomic(self, file_path: str, mode: str, **kwargs):
+        # write next to the target and rename, so an interrupted run never
+        # leaves a truncated file that a later run would take from the cache
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+        try:
+            with open(fd, mode=mode, **kwargs) as temp_file:
+                yield temp_file
+            os.chmod(temp_path, self.__file_mode)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def __create_session(self) -> requests.Session:
+        retry = Retry(
+            total=self.DOWNLOAD_RETRIES,
+            backoff_factor=self.DOWNLOAD_BACKOFF,
+            status_forcelist=self.DOWNLOAD_RETRY_STATUSES,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.POOL_CONNECTIONS,
+            pool_maxsize=self.POOL_MAXSIZE,
+            max_retries=retry,
+        )
+
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def __request_data(
+        self, href: str, stream: bool = False, headers: dict[str, str] | None = None
+    ):
+        response = self.__session.get(
+            href, timeout=self.DOWNLOAD_TIMEOUT, stream=stream, headers=headers
+        )
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            # a streamed response keeps its pooled connection until closed
+            response.close()
+            raise
 
         if self.DOWNLOAD_DELAY > 0:
             time.sleep(self.DOWNLOAD_DELAY)